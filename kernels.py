@@ -0,0 +1,274 @@
+"""
+  Numba-compiled kernels for the N-body Runge-Kutta solver.
+
+  State is passed as struct-of-arrays float64 buffers (M, x, y, vx, vy)
+  and results are written into preallocated output arrays.
+"""
+import math
+import numpy as np
+from numba import njit, prange
+from rk_common import FR_C, FR_D
+
+# Below this many bodies the serial pairwise kernel beats threading
+PARALLEL_MIN_N = 512
+
+
+@njit(fastmath=True, cache=True)
+def gravity_pairwise(M, x, y, vx, vy, dv_x, dv_y, G):
+    """
+      Serial gravity kernel visiting each unordered pair once and
+      applying equal and opposite contributions to both bodies.
+    """
+    N = M.shape[0]
+    dv_x[:] = 0.0
+    dv_y[:] = 0.0
+    for i in range(N):
+        ax_i = 0.0
+        ay_i = 0.0
+        for j in range(i+1, N):
+            dx = x[j] - x[i]
+            dy = y[j] - y[i]
+            r2 = dx*dx + dy*dy
+            inv_r3 = G/(r2*math.sqrt(r2))
+
+            ax_i += M[j]*dx*inv_r3
+            ay_i += M[j]*dy*inv_r3
+            dv_x[j] -= M[i]*dx*inv_r3
+            dv_y[j] -= M[i]*dy*inv_r3
+
+        dv_x[i] += ax_i
+        dv_y[i] += ay_i
+
+    return dv_x, dv_y, vx, vy
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def gravity_parallel(M, x, y, vx, vy, dv_x, dv_y, G):
+    """
+      Threaded gravity kernel evaluating every ordered pair, with
+      one body per prange iteration.
+    """
+    N = M.shape[0]
+    for i in prange(N):
+        # Accumulate locally, write once to avoid false sharing
+        ax_i = 0.0
+        ay_i = 0.0
+        for j in range(N):
+            if i == j:
+                continue
+            dx = x[j] - x[i]
+            dy = y[j] - y[i]
+            r2 = dx*dx + dy*dy
+            inv_r3 = 1.0/(r2*math.sqrt(r2))
+
+            ax_i += M[j]*dx*inv_r3
+            ay_i += M[j]*dy*inv_r3
+
+        dv_x[i] = G*ax_i
+        dv_y[i] = G*ay_i
+
+    return dv_x, dv_y, vx, vy
+
+
+@njit(fastmath=True, cache=True)
+def gravity(M, x, y, vx, vy, dv_x, dv_y, G):
+    """
+      System of first-order ODEs representing gravitation.
+
+      Writes accelerations to (dv_x, dv_y) and returns the
+      4-tuple (dv_x, dv_y, vx, vy).
+    """
+    if M.shape[0] >= PARALLEL_MIN_N:
+        return gravity_parallel(M, x, y, vx, vy, dv_x, dv_y, G)
+    return gravity_pairwise(M, x, y, vx, vy, dv_x, dv_y, G)
+
+
+@njit(fastmath=True, cache=True, inline="always")
+def accel_f32(xi, yi, M32, x32, y32, j0, j1):
+    # float32 pair terms, float64 accumulation
+    ax = 0.0
+    ay = 0.0
+    one = np.float32(1.0)
+    for j in range(j0, j1):
+        dx = x32[j] - xi
+        dy = y32[j] - yi
+        r2 = dx*dx + dy*dy
+        m_inv_r3 = M32[j]*(one/(r2*np.sqrt(r2)))
+        ax += m_inv_r3*dx
+        ay += m_inv_r3*dy
+    return ax, ay
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def gravity_mixed(M, x, y, vx, vy, dv_x, dv_y, G, M32, x32, y32):
+    """
+      Threaded mixed-precision gravity kernel. Masses and positions are
+      demoted to the float32 buffers (M32, x32, y32) once per call, pair
+      terms are evaluated in float32 and accumulated in float64.
+    """
+    N = M.shape[0]
+    for i in range(N):
+        M32[i] = M[i]
+        x32[i] = x[i]
+        y32[i] = y[i]
+
+    for i in prange(N):
+        # Split around i == j to keep the inner loops branch-free
+        ax_lo, ay_lo = accel_f32(x32[i], y32[i], M32, x32, y32, 0, i)
+        ax_hi, ay_hi = accel_f32(x32[i], y32[i], M32, x32, y32, i+1, N)
+        dv_x[i] = G*(ax_lo + ax_hi)
+        dv_y[i] = G*(ay_lo + ay_hi)
+
+    return dv_x, dv_y, vx, vy
+
+
+@njit(fastmath=True, cache=True)
+def forces(M, x, y, vx, vy, dv_x, dv_y, G, s, threaded=True):
+    """
+      As gravity(), or the mixed-precision kernel if Scratch s has
+      float32 buffers allocated. With threaded False the serial pairwise
+      kernel is always used.
+    """
+    if threaded:
+        if s.x32.shape[0] == M.shape[0]:
+            return gravity_mixed(M, x, y, vx, vy, dv_x, dv_y, G, s.M32, s.x32, s.y32)
+        if M.shape[0] >= PARALLEL_MIN_N:
+            return gravity_parallel(M, x, y, vx, vy, dv_x, dv_y, G)
+    return gravity_pairwise(M, x, y, vx, vy, dv_x, dv_y, G)
+
+
+@njit(fastmath=True, cache=True)
+def rk4_step(M, x, y, vx, vy, h, G, s, threaded=True):
+    """
+      Advance state arrays in place by a single RK4 step of size h.
+
+      All four stages and the weighted update are fused into one call,
+      using the preallocated Scratch buffers s.
+    """
+    N = M.shape[0]
+    h_2 = 0.5*h
+
+    forces(M, x, y, vx, vy, s.k1x, s.k1y, G, s, threaded)
+    for i in range(N):
+        s.tx[i] = x[i] + vx[i]*h_2
+        s.ty[i] = y[i] + vy[i]*h_2
+        s.k2vx[i] = vx[i] + s.k1x[i]*h_2
+        s.k2vy[i] = vy[i] + s.k1y[i]*h_2
+
+    forces(M, s.tx, s.ty, s.k2vx, s.k2vy, s.k2x, s.k2y, G, s, threaded)
+    for i in range(N):
+        s.tx[i] = x[i] + s.k2vx[i]*h_2
+        s.ty[i] = y[i] + s.k2vy[i]*h_2
+        s.k3vx[i] = vx[i] + s.k2x[i]*h_2
+        s.k3vy[i] = vy[i] + s.k2y[i]*h_2
+
+    forces(M, s.tx, s.ty, s.k3vx, s.k3vy, s.k3x, s.k3y, G, s, threaded)
+    for i in range(N):
+        s.tx[i] = x[i] + s.k3vx[i]*h
+        s.ty[i] = y[i] + s.k3vy[i]*h
+        s.k4vx[i] = vx[i] + s.k3x[i]*h
+        s.k4vy[i] = vy[i] + s.k3y[i]*h
+
+    forces(M, s.tx, s.ty, s.k4vx, s.k4vy, s.k4x, s.k4y, G, s, threaded)
+
+    h_6 = h/6.0
+    for i in range(N):
+        # Positions first, these use the stage 1 velocities
+        x[i] += h_6*(vx[i] + 2.0*(s.k2vx[i] + s.k3vx[i]) + s.k4vx[i])
+        y[i] += h_6*(vy[i] + 2.0*(s.k2vy[i] + s.k3vy[i]) + s.k4vy[i])
+        vx[i] += h_6*(s.k1x[i] + 2.0*(s.k2x[i] + s.k3x[i]) + s.k4x[i])
+        vy[i] += h_6*(s.k1y[i] + 2.0*(s.k2y[i] + s.k3y[i]) + s.k4y[i])
+
+
+@njit(fastmath=True, cache=True)
+def advance_rk4(M, x, y, vx, vy, h, G, s, n_steps, threaded=True):
+    """
+      Advance state arrays in place by n_steps RK4 steps of size h.
+    """
+    s.fsal[0] = False
+    for _ in range(n_steps):
+        rk4_step(M, x, y, vx, vy, h, G, s, threaded)
+
+
+@njit(fastmath=True, cache=True)
+def drift(x, y, vx, vy, h):
+    for i in range(x.shape[0]):
+        x[i] += vx[i]*h
+        y[i] += vy[i]*h
+
+
+@njit(fastmath=True, cache=True)
+def kick(vx, vy, dv_x, dv_y, h):
+    for i in range(vx.shape[0]):
+        vx[i] += dv_x[i]*h
+        vy[i] += dv_y[i]*h
+
+
+@njit(fastmath=True, cache=True)
+def advance_leapfrog(M, x, y, vx, vy, h, G, s, n_steps, threaded=True):
+    """
+      Advance state arrays in place by n_steps kick-drift-kick leapfrog
+      steps of size h, with one force evaluation per step.
+    """
+    h_2 = 0.5*h
+    if not s.fsal[0]:
+        forces(M, x, y, vx, vy, s.k1x, s.k1y, G, s, threaded)
+        s.fsal[0] = True
+    for _ in range(n_steps):
+        # The closing acceleration of each step opens the next
+        kick(vx, vy, s.k1x, s.k1y, h_2)
+        drift(x, y, vx, vy, h)
+        forces(M, x, y, vx, vy, s.k1x, s.k1y, G, s, threaded)
+        kick(vx, vy, s.k1x, s.k1y, h_2)
+
+
+@njit(fastmath=True, cache=True)
+def advance_forest_ruth(M, x, y, vx, vy, h, G, s, n_steps, threaded=True):
+    """
+      Advance state arrays in place by n_steps fourth-order Forest-Ruth
+      steps of size h, with three force evaluations per step.
+    """
+    s.fsal[0] = False
+    for _ in range(n_steps):
+        for k in range(3):
+            drift(x, y, vx, vy, FR_C[k]*h)
+            forces(M, x, y, vx, vy, s.k1x, s.k1y, G, s, threaded)
+            kick(vx, vy, s.k1x, s.k1y, FR_D[k]*h)
+        drift(x, y, vx, vy, FR_C[3]*h)
+
+
+@njit(cache=True)
+def member_scratch(s, e):
+    """
+      Scratch buffers of ensemble member e, as row views of the (E, n)
+      buffers in s.
+    """
+    return type(s)(s.k1x[e], s.k1y[e],
+                   s.k2x[e], s.k2y[e], s.k2vx[e], s.k2vy[e],
+                   s.k3x[e], s.k3y[e], s.k3vx[e], s.k3vy[e],
+                   s.k4x[e], s.k4y[e], s.k4vx[e], s.k4vy[e],
+                   s.tx[e], s.ty[e],
+                   s.M32[e], s.x32[e], s.y32[e],
+                   s.fsal[e])
+
+
+# Ensemble integrators take (E, N) state arrays holding E independent
+# systems. Members are advanced in parallel, each with the serial kernel
+# as nested threading is not supported.
+
+@njit(parallel=True, fastmath=True, cache=True)
+def advance_rk4_ensemble(M, x, y, vx, vy, h, G, s, n_steps):
+    for e in prange(M.shape[0]):
+        advance_rk4(M[e], x[e], y[e], vx[e], vy[e], h, G, member_scratch(s, e), n_steps, False)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def advance_leapfrog_ensemble(M, x, y, vx, vy, h, G, s, n_steps):
+    for e in prange(M.shape[0]):
+        advance_leapfrog(M[e], x[e], y[e], vx[e], vy[e], h, G, member_scratch(s, e), n_steps, False)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def advance_forest_ruth_ensemble(M, x, y, vx, vy, h, G, s, n_steps):
+    for e in prange(M.shape[0]):
+        advance_forest_ruth(M[e], x[e], y[e], vx[e], vy[e], h, G, member_scratch(s, e), n_steps, False)
@@ -0,0 +1,144 @@
+"""
+  Numba CUDA kernels for the N-body Runge-Kutta solver.
+
+  State is copied to the device once and remains resident across steps,
+  only positions are copied back to the host when sampled. Each thread
+  integrates one body, with the force sum tiled through shared memory.
+"""
+import math
+from numba import cuda, float64
+
+# Threads per block, also the shared memory tile width
+TPB = 128
+# Below this many bodies the CPU kernels win
+GPU_MIN_N = 256
+# Stage buffers: k{1..4}x, k{1..4}y, k{2..4}vx, k{2..4}vy, tx, ty
+N_BUFFERS = 16
+
+
+def is_available():
+    return cuda.is_available()
+
+
+@cuda.jit(fastmath=True)
+def gravity_gpu(M, x, y, G, out_ax, out_ay):
+    """
+      Writes accelerations due to gravitation to (out_ax, out_ay), one
+      body i per thread. Each block loads TPB bodies j at a time into
+      shared memory, which every thread in the block then reads.
+    """
+    tile = cuda.shared.array((TPB, 3), float64)
+    N = x.shape[0]
+    tid = cuda.threadIdx.x
+    i = cuda.grid(1)
+
+    xi = 0.0
+    yi = 0.0
+    if i < N:
+        xi = x[i]
+        yi = y[i]
+
+    ax_i = 0.0
+    ay_i = 0.0
+    for start in range(0, N, TPB):
+        j = start + tid
+        if j < N:
+            tile[tid, 0] = M[j]
+            tile[tid, 1] = x[j]
+            tile[tid, 2] = y[j]
+        cuda.syncthreads()
+
+        if i < N:
+            for k in range(min(TPB, N - start)):
+                if start + k == i:
+                    continue
+                dx = tile[k, 1] - xi
+                dy = tile[k, 2] - yi
+                r2 = dx*dx + dy*dy
+                inv_r3 = 1.0/(r2*math.sqrt(r2))
+
+                ax_i += tile[k, 0]*dx*inv_r3
+                ay_i += tile[k, 0]*dy*inv_r3
+        # Tile must be fully read before the next is loaded
+        cuda.syncthreads()
+
+    if i < N:
+        out_ax[i] = G*ax_i
+        out_ay[i] = G*ay_i
+
+
+@cuda.jit(fastmath=True)
+def increment_gpu(x, y, vx, vy, dv_x, dv_y, k_vx, k_vy, h, out_x, out_y, out_vx, out_vy):
+    i = cuda.grid(1)
+    if i < x.shape[0]:
+        out_x[i] = x[i] + k_vx[i]*h
+        out_y[i] = y[i] + k_vy[i]*h
+        out_vx[i] = vx[i] + dv_x[i]*h
+        out_vy[i] = vy[i] + dv_y[i]*h
+
+
+@cuda.jit(fastmath=True)
+def weighted_update_gpu(x, y, vx, vy, k1x, k1y, k2x, k2y, k2vx, k2vy,
+                        k3x, k3y, k3vx, k3vy, k4x, k4y, k4vx, k4vy, h):
+    i = cuda.grid(1)
+    if i < x.shape[0]:
+        h_6 = h/6.0
+        # Positions first, these use the stage 1 velocities
+        x[i] += h_6*(vx[i] + 2.0*(k2vx[i] + k3vx[i]) + k4vx[i])
+        y[i] += h_6*(vy[i] + 2.0*(k2vy[i] + k3vy[i]) + k4vy[i])
+        vx[i] += h_6*(k1x[i] + 2.0*(k2x[i] + k3x[i]) + k4x[i])
+        vy[i] += h_6*(k1y[i] + 2.0*(k2y[i] + k3y[i]) + k4y[i])
+
+
+class DeviceRK4():
+    """
+      RK4 integrator holding state and stage buffers on the GPU.
+    """
+    def __init__(self, M, x, y, vx, vy, G):
+        self.N = M.shape[0]
+        self.G = float(G)
+        self.blocks = (self.N + TPB - 1)//TPB
+        self.M = cuda.to_device(M)
+        self.x = cuda.to_device(x)
+        self.y = cuda.to_device(y)
+        self.vx = cuda.to_device(vx)
+        self.vy = cuda.to_device(vy)
+        self.buf = [cuda.device_array(self.N) for _ in range(N_BUFFERS)]
+
+    def step(self, h):
+        k1x, k1y, k2x, k2y, k2vx, k2vy, k3x, k3y, k3vx, k3vy, \
+            k4x, k4y, k4vx, k4vy, tx, ty = self.buf
+        M, x, y, vx, vy, G = self.M, self.x, self.y, self.vx, self.vy, self.G
+        launch = (self.blocks, TPB)
+
+        gravity_gpu[launch](M, x, y, G, k1x, k1y)
+        increment_gpu[launch](x, y, vx, vy, k1x, k1y, vx, vy, h/2, tx, ty, k2vx, k2vy)
+
+        gravity_gpu[launch](M, tx, ty, G, k2x, k2y)
+        increment_gpu[launch](x, y, vx, vy, k2x, k2y, k2vx, k2vy, h/2, tx, ty, k3vx, k3vy)
+
+        gravity_gpu[launch](M, tx, ty, G, k3x, k3y)
+        increment_gpu[launch](x, y, vx, vy, k3x, k3y, k3vx, k3vy, h, tx, ty, k4vx, k4vy)
+
+        gravity_gpu[launch](M, tx, ty, G, k4x, k4y)
+
+        weighted_update_gpu[launch](x, y, vx, vy, k1x, k1y, k2x, k2y, k2vx, k2vy,
+                                    k3x, k3y, k3vx, k3vy, k4x, k4y, k4vx, k4vy, h)
+
+    def advance(self, M, x, y, vx, vy, h, G, s, n_steps):
+        """
+          Drop-in for the host advance functions. The device state is
+          stepped instead of the arguments, with positions copied back
+          to x, y for sampling. M, vx, vy, G and s are unused.
+        """
+        for _ in range(n_steps):
+            self.step(h)
+        self.copy_positions(x, y)
+
+    def copy_positions(self, x, y):
+        self.x.copy_to_host(x)
+        self.y.copy_to_host(y)
+
+    def copy_velocities(self, vx, vy):
+        self.vx.copy_to_host(vx)
+        self.vy.copy_to_host(vy)
@@ -7,137 +7,216 @@
 #include <Python.h>
 #include <math.h>
 
-#define __version__ "0.2.0"
+#define __version__ "0.3.0"
 
-double G = 6.67408313131313e-11;  // Default G, overwrite in funcs
-/* Body instance attrs */
-PyObject *xattr  = NULL;
-PyObject *yattr  = NULL;
-PyObject *vxattr = NULL;
-PyObject *vyattr = NULL;
-PyObject *mattr  = NULL;
+#define N_ARRAYS 7
 
+#if defined(__AVX2__) && defined(__FMA__)
+#include <immintrin.h>
+#define RK_SIMD 1
+#define RK_LANES 4              // doubles per __m256d
+#define RK_PARALLEL_MIN_N 512   // below this, threading costs more than it saves
+#endif
 
-static PyObject *gravity_first_order_py(/* Unused */PyObject *self, PyObject *bodies){
+
+static int get_double_buffer(PyObject *obj, Py_buffer *view, int writable){
     /*
-     *  System of first-order ODEs representing gravitation.
-     *
-     *    - Accepts a sequence of N <Body> instances
-     *    - Returns a 4-tuple of length N arrays comprising (dv_x, dv_y, vx, vy)
-     *
+     *  Acquire a view on a 1-D, C-contiguous buffer of doubles,
+     *  e.g. a numpy float64 array.
      */
-    (void)self;  // Unused
-    PyObject *lhs = NULL, *lhs_x = NULL, *lhs_y = NULL, *lhs_vx = NULL, *lhs_vy = NULL;
-    PyObject *rhs = NULL, *rhs_x = NULL, *rhs_y = NULL;
-    PyObject *dv_x = NULL, *dv_y = NULL, *vxr = NULL, *vyr = NULL;
-
-    if(!PySequence_Check(bodies)){
-        PyErr_SetString(PyExc_ValueError, "Argument must be a sequence of <Body> instances");
-        return (PyObject *)NULL;
+    int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+    if(writable){
+        flags |= PyBUF_WRITABLE;
     }
+    if(PyObject_GetBuffer(obj, view, flags) == -1){
+        return -1;
+    }
+    if(view->ndim != 1 || view->itemsize != sizeof(double) || strcmp(view->format, "d") != 0){
+        PyErr_SetString(PyExc_ValueError, "Arguments must be 1-D contiguous float64 arrays");
+        PyBuffer_Release(view);
+        return -1;
+    }
+    return 0;
+}
 
-    Py_ssize_t len = PySequence_Size(bodies);
-
-    PyObject *ret = PyList_New((Py_ssize_t)4);   // dv_x, dv_y, vx, vy
-    dv_x = PyList_New(len);
-    dv_y = PyList_New(len);
-    vxr = PyList_New(len);
-    vyr = PyList_New(len);
 
-    /*  Lookup G from enclosing scope, falling back to above default.
-     *  This is typically fixed per model (e.g. Chencimer & Montgomery requires G=1)
-     *  but lookup here allows G to vary with iteration.
+static void gravity_pairwise(Py_ssize_t len, const double *m, const double *x, const double *y,
+                             double *dv_x, double *dv_y, double G){
+    /*
+     *  Scalar kernel visiting each pair once, contributing equal
+     *  and opposite terms to both bodies.
      */
-    PyObject *g_dict = PyEval_GetGlobals();
-    PyObject *G_ref = PyDict_GetItemString(g_dict, "G");
-    if(G_ref){
-        double _G = PyFloat_AsDouble(G_ref);
-        if(_G == -1.0){
-            PyErr_Clear();
-            PyErr_WarnEx(PyExc_UserWarning,
-                "Invalid value of 'G' defined in calling scope, "
-                "falling back to Gravitational constant.",
-                1 /* stack lev */
-            );
-        }else{
-            G = _G;
-        }
-    }else{
-        PyErr_WarnEx(PyExc_UserWarning,
-            "No value of 'G' defined in calling scope, "
-            "falling back to Gravitational constant.",
-            1 /* stack lev */
-        );
+    for(Py_ssize_t i=0; i<len; i++){
+        dv_x[i] = 0.0;
+        dv_y[i] = 0.0;
     }
 
     for(Py_ssize_t i=0; i<len; i++){
         double ret_dv_x = 0.0;
         double ret_dv_y = 0.0;
+        double lx = x[i];
+        double ly = y[i];
+
+        for(Py_ssize_t j=i+1; j<len; j++){
+            double rx = x[j];
+            double ry = y[j];
+
+            double rdiff_x = lx - rx;
+            double rdiff_y = ly - ry;
+
+            double r2 = rdiff_x*rdiff_x + rdiff_y*rdiff_y;
+            double inv_rcubed = 1.0/(r2*sqrt(r2));
+
+            double g_x = G*rdiff_x*inv_rcubed;
+            double g_y = G*rdiff_y*inv_rcubed;
 
-        lhs = PySequence_GetItem(bodies, i);
-        lhs_vx = PyObject_GetAttr(lhs, vxattr);
-        lhs_vy = PyObject_GetAttr(lhs, vyattr);
-        PyList_SetItem(vxr, i, lhs_vx);
-        PyList_SetItem(vyr, i, lhs_vy);
+            ret_dv_x -= m[j]*g_x;
+            ret_dv_y -= m[j]*g_y;
+            dv_x[j] += m[i]*g_x;
+            dv_y[j] += m[i]*g_y;
+        }
+        dv_x[i] += ret_dv_x;
+        dv_y[i] += ret_dv_y;
+    }
+}
 
-        lhs_x = PyObject_GetAttr(lhs, xattr);
-        lhs_y = PyObject_GetAttr(lhs, yattr);
-        double lx = PyFloat_AsDouble(lhs_x);
-        double ly = PyFloat_AsDouble(lhs_y);
-        Py_DECREF(lhs_x);
-        Py_DECREF(lhs_y);
+
+#ifdef RK_SIMD
+static void gravity_simd(Py_ssize_t len, const double *m, const double *x, const double *y,
+                         double *dv_x, double *dv_y, double G){
+    /*
+     *  AVX2/FMA kernel evaluating RK_LANES bodies i per iteration
+     *  against every body j, with any remaining bodies i handled by
+     *  the equivalent scalar loop.
+     */
+    const Py_ssize_t n_tiles = len/RK_LANES;
+    const __m256d zero = _mm256_setzero_pd();
+    const __m256d one = _mm256_set1_pd(1.0);
+    const __m256d vG = _mm256_set1_pd(G);
+
+    #pragma omp parallel for schedule(static) if(len >= RK_PARALLEL_MIN_N)
+    for(Py_ssize_t tile=0; tile<n_tiles; tile++){
+        const Py_ssize_t i = tile*RK_LANES;
+        const __m256d xi = _mm256_loadu_pd(x + i);
+        const __m256d yi = _mm256_loadu_pd(y + i);
+        const __m256d idx = _mm256_set_pd((double)(i+3), (double)(i+2), (double)(i+1), (double)i);
+        __m256d ax = zero;
+        __m256d ay = zero;
+
+        for(Py_ssize_t j=0; j<len; j++){
+            const __m256d dx = _mm256_sub_pd(_mm256_set1_pd(x[j]), xi);
+            const __m256d dy = _mm256_sub_pd(_mm256_set1_pd(y[j]), yi);
+            /* Lane where i == j: substitute r2 = 1 then zero its contribution */
+            const __m256d self = _mm256_cmp_pd(idx, _mm256_set1_pd((double)j), _CMP_EQ_OQ);
+
+            __m256d r2 = _mm256_fmadd_pd(dy, dy, _mm256_mul_pd(dx, dx));
+            r2 = _mm256_blendv_pd(r2, one, self);
+            const __m256d inv_rcubed = _mm256_div_pd(one, _mm256_mul_pd(r2, _mm256_sqrt_pd(r2)));
+            const __m256d m_inv_rcubed = _mm256_andnot_pd(self, _mm256_mul_pd(_mm256_set1_pd(m[j]), inv_rcubed));
+
+            ax = _mm256_fmadd_pd(m_inv_rcubed, dx, ax);
+            ay = _mm256_fmadd_pd(m_inv_rcubed, dy, ay);
+        }
+        _mm256_storeu_pd(dv_x + i, _mm256_mul_pd(vG, ax));
+        _mm256_storeu_pd(dv_y + i, _mm256_mul_pd(vG, ay));
+    }
+
+    for(Py_ssize_t i=n_tiles*RK_LANES; i<len; i++){
+        double ret_dv_x = 0.0;
+        double ret_dv_y = 0.0;
 
         for(Py_ssize_t j=0; j<len; j++){
             if(i == j){
                 continue;
             }
-            rhs = PySequence_GetItem(bodies, j);
-            PyObject *mp = PyObject_GetAttr(rhs, mattr);
-            double m = PyFloat_AsDouble(mp);
-            double GM = -G*m;
+            double rdiff_x = x[j] - x[i];
+            double rdiff_y = y[j] - y[i];
 
-            rhs_x = PyObject_GetAttr(rhs, xattr);
-            rhs_y = PyObject_GetAttr(rhs, yattr);
-            double rx = PyFloat_AsDouble(rhs_x);
-            double ry = PyFloat_AsDouble(rhs_y);
+            double r2 = rdiff_x*rdiff_x + rdiff_y*rdiff_y;
+            double inv_rcubed = 1.0/(r2*sqrt(r2));
 
-            double rdiff_x = lx - rx;
-            double rdiff_y = ly - ry;
+            ret_dv_x += m[j]*rdiff_x*inv_rcubed;
+            ret_dv_y += m[j]*rdiff_y*inv_rcubed;
+        }
+        dv_x[i] = G*ret_dv_x;
+        dv_y[i] = G*ret_dv_y;
+    }
+}
+#endif
 
-            double rcubed = pow(pow(rx - lx, 2.0) + pow(ry - ly, 2.0), 3.0/2.0);
 
-            ret_dv_x += GM*rdiff_x/rcubed;
-            ret_dv_y += GM*rdiff_y/rcubed;
+static PyObject *gravity_first_order_py(/* Unused */PyObject *self, PyObject *args){
+    /*
+     *  System of first-order ODEs representing gravitation.
+     *
+     *    - Accepts length N arrays (M, x, y, vx, vy), length N output
+     *      arrays (dv_x, dv_y) and the gravitational constant G
+     *    - Writes accelerations to (dv_x, dv_y) and returns the
+     *      4-tuple (dv_x, dv_y, vx, vy)
+     *
+     */
+    (void)self;  // Unused
+    PyObject *objs[N_ARRAYS];
+    Py_buffer views[N_ARRAYS];
+    double G;
+    int acquired = 0;
+    PyObject *ret = NULL;
+
+    if(!PyArg_ParseTuple(args, "OOOOOOOd:gravity_first_order",
+                         &objs[0], &objs[1], &objs[2], &objs[3], &objs[4],
+                         &objs[5], &objs[6], &G)){
+        return (PyObject *)NULL;
+    }
 
-            Py_DECREF(mp);
-            Py_DECREF(rhs);
-            Py_DECREF(rhs_x);
-            Py_DECREF(rhs_y);
+    /* M, x, y, vx, vy are read-only; dv_x, dv_y are written */
+    for(; acquired<N_ARRAYS; acquired++){
+        if(get_double_buffer(objs[acquired], &views[acquired], acquired >= 5) == -1){
+            goto release;
         }
-        PyObject *ret_dv_xp = Py_BuildValue("d", ret_dv_x);
-        PyObject *ret_dv_yp = Py_BuildValue("d", ret_dv_y);
+    }
 
-        PyList_SetItem(dv_x, i, ret_dv_xp);
-        PyList_SetItem(dv_y, i, ret_dv_yp);
+    Py_ssize_t len = views[0].shape[0];
+    for(int k=1; k<N_ARRAYS; k++){
+        if(views[k].shape[0] != len){
+            PyErr_SetString(PyExc_ValueError, "Arrays must all be of equal length");
+            goto release;
+        }
     }
 
-    PyList_SetItem(ret, 0, dv_x);
-    PyList_SetItem(ret, 1, dv_y);
-    PyList_SetItem(ret, 2, vxr);
-    PyList_SetItem(ret, 3, vyr);
+    const double *m = views[0].buf;
+    const double *x = views[1].buf;
+    const double *y = views[2].buf;
+    double *dv_x = views[5].buf;
+    double *dv_y = views[6].buf;
 
+#ifdef RK_SIMD
+    if(len >= RK_LANES){
+        gravity_simd(len, m, x, y, dv_x, dv_y, G);
+    }else{
+        gravity_pairwise(len, m, x, y, dv_x, dv_y, G);
+    }
+#else
+    gravity_pairwise(len, m, x, y, dv_x, dv_y, G);
+#endif
+
+    ret = PyTuple_Pack(4, objs[5], objs[6], objs[3], objs[4]);
+
+release:
+    while(acquired-- > 0){
+        PyBuffer_Release(&views[acquired]);
+    }
     return ret;
 }
 
 
 static char gravity_first_order_doc[] =
     "System of first-order ODEs representing gravitation.\n"
-    "  - Accepts a sequence of N <Body> instances\n"
-    "  - Returns a 4-tuple of length N arrays comprising (dv_x, dv_y, vx, vy) per Body";
+    "  - Accepts length N float64 arrays (M, x, y, vx, vy), output arrays (dv_x, dv_y) and G\n"
+    "  - Writes accelerations to (dv_x, dv_y) and returns the 4-tuple (dv_x, dv_y, vx, vy)";
 
 static PyMethodDef rkfuncs_module_methods[] = {
     {"gravity_first_order", (PyCFunction)gravity_first_order_py,
-     METH_O, gravity_first_order_doc},
+     METH_VARARGS, gravity_first_order_doc},
     {NULL, NULL, 0, NULL} /* sentinel */
 };
 
@@ -152,13 +231,6 @@ static struct PyModuleDef rkfuncs_module_def = {
 PyMODINIT_FUNC PyInit_rkfuncs(void){
     Py_Initialize();
 
-    /* Body instance attributes */
-    xattr  = Py_BuildValue("s", "x");
-    yattr  = Py_BuildValue("s", "y");
-    vxattr = Py_BuildValue("s", "vx");
-    vyattr = Py_BuildValue("s", "vy");
-    mattr  = Py_BuildValue("s", "M");
-
     PyObject *mod = PyModule_Create(&rkfuncs_module_def);
     PyModule_AddStringMacro(mod, __version__);
     return mod;
@@ -10,13 +10,14 @@
 
   - Paul Slavin
 """
-import math
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
 points = []
 
 class Body():
+    __slots__ = ("M", "x", "y", "vx", "vy")
+
     def __init__(self, M, x, y, vx=0.0, vy=0.0):
         self.M = M
         self.x = float(x)
@@ -24,38 +25,51 @@ class Body():
         self.vx = float(vx)
         self.vy = float(vy)
 
-    def distance(self, rhs):
-        return math.sqrt((rhs.x - self.x)**2 + (rhs.y - self.y)**2)
-
     def __str__(self):
         return f"M: {self.M:8g} ({self.x:12.9f}, {self.y:12.9f}) v_x: {self.vx:10.8f}, v_y: {self.vy:10.8f}"
 
 
-def f0(b0, b1, b2):
-    dv_x = 0.0
-    dv_y = 0.0
-
-    GM_1 = -G*b1.M
+def pair_dists(b1, b2, b3):
+    # Separation and inverse cube distance of each pair, straight from r^2
+    rdiff_x_12 = b1.x - b2.x
+    rdiff_y_12 = b1.y - b2.y
+    inv_rcubed_12 = (rdiff_x_12*rdiff_x_12 + rdiff_y_12*rdiff_y_12)**-1.5
 
-    rdiff_x_1 = b0.x - b1.x
-    rdiff_y_1 = b0.y - b1.y
+    rdiff_x_13 = b1.x - b3.x
+    rdiff_y_13 = b1.y - b3.y
+    inv_rcubed_13 = (rdiff_x_13*rdiff_x_13 + rdiff_y_13*rdiff_y_13)**-1.5
 
-    rcubed_1 = b0.distance(b1)**3
+    rdiff_x_23 = b2.x - b3.x
+    rdiff_y_23 = b2.y - b3.y
+    inv_rcubed_23 = (rdiff_x_23*rdiff_x_23 + rdiff_y_23*rdiff_y_23)**-1.5
 
-    dv_x += GM_1*rdiff_x_1/rcubed_1
-    dv_y += GM_1*rdiff_y_1/rcubed_1
+    return (rdiff_x_12, rdiff_y_12, inv_rcubed_12,
+            rdiff_x_13, rdiff_y_13, inv_rcubed_13,
+            rdiff_x_23, rdiff_y_23, inv_rcubed_23)
 
-    GM_2 = -G*b2.M
 
-    rdiff_x_2 = b0.x - b2.x
-    rdiff_y_2 = b0.y - b2.y
+def f0_three(b1, b2, b3, G):
+    # Accelerations of all three bodies, computing each pair term once
+    rdiff_x_12, rdiff_y_12, inv_rcubed_12, \
+        rdiff_x_13, rdiff_y_13, inv_rcubed_13, \
+        rdiff_x_23, rdiff_y_23, inv_rcubed_23 = pair_dists(b1, b2, b3)
 
-    rcubed_2 = b0.distance(b2)**3
+    # Each pair term acts on both bodies of the pair, in opposite senses
+    G_x_12 = G*rdiff_x_12*inv_rcubed_12
+    G_y_12 = G*rdiff_y_12*inv_rcubed_12
+    G_x_13 = G*rdiff_x_13*inv_rcubed_13
+    G_y_13 = G*rdiff_y_13*inv_rcubed_13
+    G_x_23 = G*rdiff_x_23*inv_rcubed_23
+    G_y_23 = G*rdiff_y_23*inv_rcubed_23
 
-    dv_x += GM_2*rdiff_x_2/rcubed_2
-    dv_y += GM_2*rdiff_y_2/rcubed_2
+    a1_x = -b2.M*G_x_12 - b3.M*G_x_13
+    a1_y = -b2.M*G_y_12 - b3.M*G_y_13
+    a2_x = b1.M*G_x_12 - b3.M*G_x_23
+    a2_y = b1.M*G_y_12 - b3.M*G_y_23
+    a3_x = b1.M*G_x_13 + b2.M*G_x_23
+    a3_y = b1.M*G_y_13 + b2.M*G_y_23
 
-    return dv_x, dv_y, b0.vx, b0.vy
+    return a1_x, a1_y, a2_x, a2_y, a3_x, a3_y
 
 
 def plot_animated(points, footnote=None):
@@ -129,77 +143,80 @@ print("b2: ", b2)
 print("b3: ", b3)
 print("")
 
+# Loop-invariant step fractions
+h_half = 0.5*h
+h_sixth = h/6.0
+
+# Func args at each increment (positions only), reused between stages and steps
+b1_t = Body(b1.M, b1.x, b1.y)
+b2_t = Body(b2.M, b2.x, b2.y)
+b3_t = Body(b3.M, b3.x, b3.y)
+
 step = 0
 while t < t_f:
     # Calculate slope k1 at starting point
-    k1_1_x, k1_1_y, k1_1_vx, k1_1_vy = f0(b1, b2, b3)
-    k1_2_x, k1_2_y, k1_2_vx, k1_2_vy = f0(b2, b1, b3)
-    k1_3_x, k1_3_y, k1_3_vx, k1_3_vy = f0(b3, b1, b2)
+    k1_1_x, k1_1_y, k1_2_x, k1_2_y, k1_3_x, k1_3_y = f0_three(b1, b2, b3, G)
 
     # Extend slope k1 to midpoint for position: r + dv/dt*t/2
-    b1_k1_x = b1.x + k1_1_vx*h/2
-    b2_k1_x = b2.x + k1_2_vx*h/2
-    b3_k1_x = b3.x + k1_3_vx*h/2
+    b1_k1_x = b1.x + b1.vx*h_half
+    b2_k1_x = b2.x + b2.vx*h_half
+    b3_k1_x = b3.x + b3.vx*h_half
 
-    b1_k1_y = b1.y + k1_1_vy*h/2
-    b2_k1_y = b2.y + k1_2_vy*h/2
-    b3_k1_y = b3.y + k1_3_vy*h/2
+    b1_k1_y = b1.y + b1.vy*h_half
+    b2_k1_y = b2.y + b2.vy*h_half
+    b3_k1_y = b3.y + b3.vy*h_half
 
     # Extend slope k1 to midpoint for velocity: dv/dt + d2v/dt2*h/2
-    b1_k1_vx = b1.vx + k1_1_x*h/2
-    b2_k1_vx = b2.vx + k1_2_x*h/2
-    b3_k1_vx = b3.vx + k1_3_x*h/2
+    b1_k1_vx = b1.vx + k1_1_x*h_half
+    b2_k1_vx = b2.vx + k1_2_x*h_half
+    b3_k1_vx = b3.vx + k1_3_x*h_half
 
-    b1_k1_vy = b1.vy + k1_1_y*h/2
-    b2_k1_vy = b2.vy + k1_2_y*h/2
-    b3_k1_vy = b3.vy + k1_3_y*h/2
+    b1_k1_vy = b1.vy + k1_1_y*h_half
+    b2_k1_vy = b2.vy + k1_2_y*h_half
+    b3_k1_vy = b3.vy + k1_3_y*h_half
 
-    # Create midpoint func args from slope k1
-    b1_t = Body(b1.M, b1_k1_x, b1_k1_y, b1_k1_vx, b1_k1_vy)
-    b2_t = Body(b2.M, b2_k1_x, b2_k1_y, b2_k1_vx, b2_k1_vy)
-    b3_t = Body(b3.M, b3_k1_x, b3_k1_y, b3_k1_vx, b3_k1_vy)
+    # Update midpoint func args from slope k1
+    b1_t.x, b1_t.y = b1_k1_x, b1_k1_y
+    b2_t.x, b2_t.y = b2_k1_x, b2_k1_y
+    b3_t.x, b3_t.y = b3_k1_x, b3_k1_y
 
     # Calculate slope k2 at midpoint
-    k2_1_x, k2_1_y, k2_1_vx, k2_1_vy = f0(b1_t, b2_t, b3_t)
-    k2_2_x, k2_2_y, k2_2_vx, k2_2_vy = f0(b2_t, b1_t, b3_t)
-    k2_3_x, k2_3_y, k2_3_vx, k2_3_vy = f0(b3_t, b1_t, b2_t)
+    k2_1_x, k2_1_y, k2_2_x, k2_2_y, k2_3_x, k2_3_y = f0_three(b1_t, b2_t, b3_t, G)
 
     # Extend slope k2 to midpoint for position: r + dv/dt*t/2
-    b1_k2_x = b1.x + k2_1_vx*h/2
-    b2_k2_x = b2.x + k2_2_vx*h/2
-    b3_k2_x = b3.x + k2_3_vx*h/2
+    b1_k2_x = b1.x + b1_k1_vx*h_half
+    b2_k2_x = b2.x + b2_k1_vx*h_half
+    b3_k2_x = b3.x + b3_k1_vx*h_half
 
-    b1_k2_y = b1.y + k2_1_vy*h/2
-    b2_k2_y = b2.y + k2_2_vy*h/2
-    b3_k2_y = b3.y + k2_3_vy*h/2
+    b1_k2_y = b1.y + b1_k1_vy*h_half
+    b2_k2_y = b2.y + b2_k1_vy*h_half
+    b3_k2_y = b3.y + b3_k1_vy*h_half
 
     # Extend slope k2 to midpoint for velocity: dv/dt + d2v/dt2*h/2
-    b1_k2_vx = b1.vx + k2_1_x*h/2
-    b2_k2_vx = b2.vx + k2_2_x*h/2
-    b3_k2_vx = b3.vx + k2_3_x*h/2
+    b1_k2_vx = b1.vx + k2_1_x*h_half
+    b2_k2_vx = b2.vx + k2_2_x*h_half
+    b3_k2_vx = b3.vx + k2_3_x*h_half
 
-    b1_k2_vy = b1.vy + k2_1_y*h/2
-    b2_k2_vy = b2.vy + k2_2_y*h/2
-    b3_k2_vy = b3.vy + k2_3_y*h/2
+    b1_k2_vy = b1.vy + k2_1_y*h_half
+    b2_k2_vy = b2.vy + k2_2_y*h_half
+    b3_k2_vy = b3.vy + k2_3_y*h_half
 
-    # Create midpoint func args from slope k2
-    b1_t = Body(b1.M, b1_k2_x, b1_k2_y, b1_k2_vx, b1_k2_vy)
-    b2_t = Body(b2.M, b2_k2_x, b2_k2_y, b2_k2_vx, b2_k2_vy)
-    b3_t = Body(b3.M, b3_k2_x, b3_k2_y, b3_k2_vx, b3_k2_vy)
+    # Update midpoint func args from slope k2
+    b1_t.x, b1_t.y = b1_k2_x, b1_k2_y
+    b2_t.x, b2_t.y = b2_k2_x, b2_k2_y
+    b3_t.x, b3_t.y = b3_k2_x, b3_k2_y
 
     # Calculate slope k3 at midpoint
-    k3_1_x, k3_1_y, k3_1_vx, k3_1_vy = f0(b1_t, b2_t, b3_t)
-    k3_2_x, k3_2_y, k3_2_vx, k3_2_vy = f0(b2_t, b1_t, b3_t)
-    k3_3_x, k3_3_y, k3_3_vx, k3_3_vy = f0(b3_t, b1_t, b2_t)
+    k3_1_x, k3_1_y, k3_2_x, k3_2_y, k3_3_x, k3_3_y = f0_three(b1_t, b2_t, b3_t, G)
 
     # Extend slope k3 to endpoint for position: r + dv/dt*t/2
-    b1_k3_x = b1.x + k3_1_vx*h
-    b2_k3_x = b2.x + k3_2_vx*h
-    b3_k3_x = b3.x + k3_3_vx*h
+    b1_k3_x = b1.x + b1_k2_vx*h
+    b2_k3_x = b2.x + b2_k2_vx*h
+    b3_k3_x = b3.x + b3_k2_vx*h
 
-    b1_k3_y = b1.y + k3_1_vy*h
-    b2_k3_y = b2.y + k3_2_vy*h
-    b3_k3_y = b3.y + k3_3_vy*h
+    b1_k3_y = b1.y + b1_k2_vy*h
+    b2_k3_y = b2.y + b2_k2_vy*h
+    b3_k3_y = b3.y + b3_k2_vy*h
 
     # Extend slope k3 to endpoint for velocity: dv/dt + d2v/dt2*h/2
     b1_k3_vx = b1.vx + k3_1_x*h
@@ -210,33 +227,31 @@ while t < t_f:
     b2_k3_vy = b2.vy + k3_2_y*h
     b3_k3_vy = b3.vy + k3_3_y*h
 
-    # Create endpoint func args from slope k3
-    b1_t = Body(b1.M, b1_k3_x, b1_k3_y, b1_k3_vx, b1_k3_vy)
-    b2_t = Body(b2.M, b2_k3_x, b2_k3_y, b2_k3_vx, b2_k3_vy)
-    b3_t = Body(b3.M, b3_k3_x, b3_k3_y, b3_k3_vx, b3_k3_vy)
+    # Update endpoint func args from slope k3
+    b1_t.x, b1_t.y = b1_k3_x, b1_k3_y
+    b2_t.x, b2_t.y = b2_k3_x, b2_k3_y
+    b3_t.x, b3_t.y = b3_k3_x, b3_k3_y
 
     # Calculate slope k4 at endpoint
-    k4_1_x, k4_1_y, k4_1_vx, k4_1_vy = f0(b1_t, b2_t, b3_t)
-    k4_2_x, k4_2_y, k4_2_vx, k4_2_vy = f0(b2_t, b1_t, b3_t)
-    k4_3_x, k4_3_y, k4_3_vx, k4_3_vy = f0(b3_t, b1_t, b2_t)
+    k4_1_x, k4_1_y, k4_2_x, k4_2_y, k4_3_x, k4_3_y = f0_three(b1_t, b2_t, b3_t, G)
 
     # Extend weighted slopes to endpoint for position
-    b1_h_x = b1.x + 1/6*(k1_1_vx + 2*(k2_1_vx + k3_1_vx) + k4_1_vx)*h
-    b2_h_x = b2.x + 1/6*(k1_2_vx + 2*(k2_2_vx + k3_2_vx) + k4_2_vx)*h
-    b3_h_x = b3.x + 1/6*(k1_3_vx + 2*(k2_3_vx + k3_3_vx) + k4_3_vx)*h
+    b1_h_x = b1.x + h_sixth*(b1.vx + 2*(b1_k1_vx + b1_k2_vx) + b1_k3_vx)
+    b2_h_x = b2.x + h_sixth*(b2.vx + 2*(b2_k1_vx + b2_k2_vx) + b2_k3_vx)
+    b3_h_x = b3.x + h_sixth*(b3.vx + 2*(b3_k1_vx + b3_k2_vx) + b3_k3_vx)
 
-    b1_h_y = b1.y + 1/6*(k1_1_vy + 2*(k2_1_vy + k3_1_vy) + k4_1_vy)*h
-    b2_h_y = b2.y + 1/6*(k1_2_vy + 2*(k2_2_vy + k3_2_vy) + k4_2_vy)*h
-    b3_h_y = b3.y + 1/6*(k1_3_vy + 2*(k2_3_vy + k3_3_vy) + k4_3_vy)*h
+    b1_h_y = b1.y + h_sixth*(b1.vy + 2*(b1_k1_vy + b1_k2_vy) + b1_k3_vy)
+    b2_h_y = b2.y + h_sixth*(b2.vy + 2*(b2_k1_vy + b2_k2_vy) + b2_k3_vy)
+    b3_h_y = b3.y + h_sixth*(b3.vy + 2*(b3_k1_vy + b3_k2_vy) + b3_k3_vy)
 
     # Extend weighted slopes to endpoint for velocity
-    b1_h_vx = b1.vx + 1/6*(k1_1_x + 2*(k2_1_x + k3_1_x) + k4_1_x)*h
-    b2_h_vx = b2.vx + 1/6*(k1_2_x + 2*(k2_2_x + k3_2_x) + k4_2_x)*h
-    b3_h_vx = b3.vx + 1/6*(k1_3_x + 2*(k2_3_x + k3_3_x) + k4_3_x)*h
+    b1_h_vx = b1.vx + h_sixth*(k1_1_x + 2*(k2_1_x + k3_1_x) + k4_1_x)
+    b2_h_vx = b2.vx + h_sixth*(k1_2_x + 2*(k2_2_x + k3_2_x) + k4_2_x)
+    b3_h_vx = b3.vx + h_sixth*(k1_3_x + 2*(k2_3_x + k3_3_x) + k4_3_x)
 
-    b1_h_vy = b1.vy + 1/6*(k1_1_y + 2*(k2_1_y + k3_1_y) + k4_1_y)*h
-    b2_h_vy = b2.vy + 1/6*(k1_2_y + 2*(k2_2_y + k3_2_y) + k4_2_y)*h
-    b3_h_vy = b3.vy + 1/6*(k1_3_y + 2*(k2_3_y + k3_3_y) + k4_3_y)*h
+    b1_h_vy = b1.vy + h_sixth*(k1_1_y + 2*(k2_1_y + k3_1_y) + k4_1_y)
+    b2_h_vy = b2.vy + h_sixth*(k1_2_y + 2*(k2_2_y + k3_2_y) + k4_2_y)
+    b3_h_vy = b3.vy + h_sixth*(k1_3_y + 2*(k2_3_y + k3_3_y) + k4_3_y)
 
     b1.x = b1_h_x
     b1.y = b1_h_y
@@ -0,0 +1,56 @@
+"""
+  Definitions shared by rk_nbody.py and the compiled kernels.
+
+  rk_nbody.py runs as __main__, so types passed to the cached Numba
+  kernels live here where they have an importable module name.
+"""
+from collections import namedtuple
+import numpy as np
+
+# Forest-Ruth drift (c) and kick (d) coefficients
+FR_THETA = 1.0/(2.0 - 2.0**(1.0/3.0))
+FR_C = (FR_THETA/2.0, (1.0 - FR_THETA)/2.0, (1.0 - FR_THETA)/2.0, FR_THETA/2.0)
+FR_D = (FR_THETA, 1.0 - 2.0*FR_THETA, FR_THETA)
+
+"""
+  Preallocated per-step buffers: accelerations k{n}x, k{n}y and velocities
+  k{n}vx, k{n}vy for each RK4 stage, plus positions tx, ty at the current
+  increment. Stage 1 velocities are those of the state itself.
+
+  Float32 buffers M32, x32, y32 are only allocated for the
+  mixed-precision compiled kernel, and are otherwise empty.
+
+  The one-element flag fsal is set while k1x, k1y hold accelerations at
+  the current state, so leapfrog reuses them across calls. Integrators
+  which overwrite k1x, k1y otherwise clear it.
+
+  For an ensemble of E systems every buffer gains a leading axis of E,
+  with member e using row e.
+"""
+Scratch = namedtuple("Scratch", (
+    "k1x", "k1y",
+    "k2x", "k2y", "k2vx", "k2vy",
+    "k3x", "k3y", "k3vx", "k3vy",
+    "k4x", "k4y", "k4vx", "k4vy",
+    "tx", "ty",
+    "M32", "x32", "y32",
+    "fsal",
+))
+
+
+def make_scratch(N, mixed_precision=False, ensemble_size=1):
+    n_32 = N if mixed_precision else 0
+    shape = ()
+    if ensemble_size > 1:
+        # Members are threaded individually and run the serial kernel
+        shape = (ensemble_size,)
+        n_32 = 0
+    buffers = []
+    for f in Scratch._fields:
+        if f.endswith("32"):
+            buffers.append(np.empty(shape + (n_32,), dtype=np.float32))
+        elif f == "fsal":
+            buffers.append(np.zeros(shape + (1,), dtype=np.bool_))
+        else:
+            buffers.append(np.empty(shape + (N,), dtype=np.float64))
+    return Scratch(*buffers)
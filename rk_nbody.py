@@ -1,21 +1,30 @@
 """
-  N-body simulator using a fourth-order Runge-Kutta scheme
+  N-body simulator using a fourth-order Runge-Kutta scheme, or
+  alternatively symplectic leapfrog or Forest-Ruth integrators, or
+  adaptive Dormand-Prince (DOP853)
 """
 import atexit
 import math
+import os
 import random
+import subprocess
+import sys
 import time
 import warnings
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+import numpy as np
+from rk_common import FR_C, FR_D, Scratch, make_scratch
+from rk_view import HEADER_LEN, block_size, ring_views, write_footnote
 
-# Note compiled extension import below
+# Note compiled kernel imports below
 
 bodies = []
-points = []
 
 
 class Body():
+    __slots__ = ("M", "x", "y", "vx", "vy")
+
     def __init__(self, M, x, y, vx=0.0, vy=0.0):
         self.M = float(M)
         self.x = float(x)
@@ -27,104 +36,264 @@ class Body():
         return f"M: {self.M:8g} ({self.x:12.9f}, {self.y:12.9f}) v_x: {self.vx:10.8f}, v_y: {self.vy:10.8f}"
 
 
+@dataclass
+class State():
+    """
+      Struct-of-arrays state for N bodies, each attribute a
+      contiguous float64 array of length N.
+    """
+    M: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    vx: np.ndarray
+    vy: np.ndarray
+
+    @classmethod
+    def empty(cls, N):
+        return cls(*(np.empty(N, dtype=np.float64) for _ in range(5)))
+
+    @classmethod
+    def from_bodies(cls, bodies):
+        state = cls.empty(len(bodies))
+        for idx, b in enumerate(bodies):
+            state.M[idx] = b.M
+            state.x[idx] = b.x
+            state.y[idx] = b.y
+            state.vx[idx] = b.vx
+            state.vy[idx] = b.vy
+        return state
+
+    def to_bodies(self):
+        return [Body(*attrs) for attrs in zip(self.M, self.x, self.y, self.vx, self.vy)]
+
+    def member(self, e):
+        # Views of row e of an ensemble's (E, N) arrays
+        return State(self.M[e], self.x[e], self.y[e], self.vx[e], self.vy[e])
+
+
+def make_ensemble(state, ensemble_size, spread):
+    """
+      Ensemble of ensemble_size copies of state as (E, N) arrays. Member 0
+      is unperturbed, positions of the others are offset by gaussian noise
+      of standard deviation spread.
+    """
+    ensemble = State(*(np.tile(a, (ensemble_size, 1))
+                       for a in (state.M, state.x, state.y, state.vx, state.vy)))
+    rng = np.random.default_rng()
+    ensemble.x[1:] += rng.normal(0.0, spread, ensemble.x[1:].shape)
+    ensemble.y[1:] += rng.normal(0.0, spread, ensemble.y[1:].shape)
+    return ensemble
+
+
 @atexit.register
 def show_cursor():
     # meh
     print('\033[?25h', end="")
 
 
-def f1(bodies):
-    dv_x, dv_y, vx, vy = [], [], [], []
-    for i0, lhs in enumerate(bodies):
-        dv_x.append(0.0)
-        dv_y.append(0.0)
-        vx.append(lhs.vx)
-        vy.append(lhs.vy)
-        for rhs in [b for i1, b in enumerate(bodies) if i0 != i1]:
-            GM = -G*rhs.M
-            rdiff_x = lhs.x - rhs.x
-            rdiff_y = lhs.y - rhs.y
+def f1(M, x, y, vx, vy, dv_x, dv_y, G):
+    # Pairwise separations as (N, N) arrays, row i holding r_i - r_j
+    rdiff_x = x[:, None] - x[None, :]
+    rdiff_y = y[:, None] - y[None, :]
+    r2 = rdiff_x*rdiff_x + rdiff_y*rdiff_y
 
-            rcubed = ((rhs.x - lhs.x)**2 + (rhs.y - lhs.y)**2)**(3/2)
+    # Exclude self-interaction, inf**-1.5 == 0
+    np.fill_diagonal(r2, np.inf)
+    GM_rcubed = -G*M[None, :]*r2**-1.5
 
-            dv_x[i0] += GM*rdiff_x/rcubed
-            dv_y[i0] += GM*rdiff_y/rcubed
+    np.sum(GM_rcubed*rdiff_x, axis=1, out=dv_x)
+    np.sum(GM_rcubed*rdiff_y, axis=1, out=dv_y)
 
     return dv_x, dv_y, vx, vy
 
+
+def increment(x, y, vx, vy, dv_x, dv_y, k_vx, k_vy, h, out_x, out_y, out_vx, out_vy):
+    # Extend slope for position: r + dv/dt*h
+    np.multiply(k_vx, h, out=out_x)
+    np.add(x, out_x, out=out_x)
+    np.multiply(k_vy, h, out=out_y)
+    np.add(y, out_y, out=out_y)
+
+    # Extend slope for velocity: dv/dt + d2v/dt2*h
+    np.multiply(dv_x, h, out=out_vx)
+    np.add(vx, out_vx, out=out_vx)
+    np.multiply(dv_y, h, out=out_vy)
+    np.add(vy, out_vy, out=out_vy)
+
+
+def weighted_update(r, k1, k2, k3, k4, h_sixth, tmp):
+    # r + h/6*(k1 + 2*(k2 + k3) + k4)
+    np.add(k2, k3, out=tmp)
+    np.multiply(tmp, 2.0, out=tmp)
+    np.add(tmp, k1, out=tmp)
+    np.add(tmp, k4, out=tmp)
+    np.multiply(tmp, h_sixth, out=tmp)
+    np.add(r, tmp, out=r)
+
+
+def rk4_step(M, x, y, vx, vy, h, G, s):
+    """
+      Advance state arrays in place by a single RK4 step of size h,
+      using the preallocated Scratch buffers s.
+    """
+    h_half = 0.5*h
+    h_sixth = h/6.0
+
+    k1_x, k1_y, k1_vx, k1_vy = f1(M, x, y, vx, vy, s.k1x, s.k1y, G)
+    increment(x, y, vx, vy, k1_x, k1_y, k1_vx, k1_vy, h_half, s.tx, s.ty, s.k2vx, s.k2vy)
+
+    k2_x, k2_y, k2_vx, k2_vy = f1(M, s.tx, s.ty, s.k2vx, s.k2vy, s.k2x, s.k2y, G)
+    increment(x, y, vx, vy, k2_x, k2_y, k2_vx, k2_vy, h_half, s.tx, s.ty, s.k3vx, s.k3vy)
+
+    k3_x, k3_y, k3_vx, k3_vy = f1(M, s.tx, s.ty, s.k3vx, s.k3vy, s.k3x, s.k3y, G)
+    increment(x, y, vx, vy, k3_x, k3_y, k3_vx, k3_vy, h, s.tx, s.ty, s.k4vx, s.k4vy)
+
+    k4_x, k4_y, k4_vx, k4_vy = f1(M, s.tx, s.ty, s.k4vx, s.k4vy, s.k4x, s.k4y, G)
+
+    # Positions at increments are no longer needed, reuse as temporary
+    weighted_update(x, k1_vx, k2_vx, k3_vx, k4_vx, h_sixth, s.tx)
+    weighted_update(y, k1_vy, k2_vy, k3_vy, k4_vy, h_sixth, s.tx)
+    weighted_update(vx, k1_x, k2_x, k3_x, k4_x, h_sixth, s.tx)
+    weighted_update(vy, k1_y, k2_y, k3_y, k4_y, h_sixth, s.tx)
+
+
+def advance_rk4(M, x, y, vx, vy, h, G, s, n_steps):
+    s.fsal[0] = False
+    for _ in range(n_steps):
+        rk4_step(M, x, y, vx, vy, h, G, s)
+
+
+def drift(x, y, vx, vy, h, s):
+    # r + v*h
+    np.multiply(vx, h, out=s.tx)
+    np.add(x, s.tx, out=x)
+    np.multiply(vy, h, out=s.ty)
+    np.add(y, s.ty, out=y)
+
+
+def kick(vx, vy, dv_x, dv_y, h, s):
+    # v + dv/dt*h
+    np.multiply(dv_x, h, out=s.tx)
+    np.add(vx, s.tx, out=vx)
+    np.multiply(dv_y, h, out=s.ty)
+    np.add(vy, s.ty, out=vy)
+
+
+def advance_leapfrog(M, x, y, vx, vy, h, G, s, n_steps):
+    h_half = 0.5*h
+    if not s.fsal[0]:
+        f1(M, x, y, vx, vy, s.k1x, s.k1y, G)
+        s.fsal[0] = True
+    for _ in range(n_steps):
+        # Kick-drift-kick, the closing acceleration of each step opens the next
+        kick(vx, vy, s.k1x, s.k1y, h_half, s)
+        drift(x, y, vx, vy, h, s)
+        f1(M, x, y, vx, vy, s.k1x, s.k1y, G)
+        kick(vx, vy, s.k1x, s.k1y, h_half, s)
+
+
+def advance_forest_ruth(M, x, y, vx, vy, h, G, s, n_steps):
+    c_h = [c*h for c in FR_C]
+    d_h = [d*h for d in FR_D]
+    s.fsal[0] = False
+    for _ in range(n_steps):
+        for k in range(3):
+            drift(x, y, vx, vy, c_h[k], s)
+            dv_x, dv_y, _, _ = f1(M, x, y, vx, vy, s.k1x, s.k1y, G)
+            kick(vx, vy, dv_x, dv_y, d_h[k], s)
+        drift(x, y, vx, vy, c_h[3], s)
+
+
+def ensemble_of(advance):
+    """
+      Ensemble form of advance(), stepping each member of (E, N) state
+      arrays in turn with its own rows of the Scratch buffers s.
+    """
+    def advance_ensemble(M, x, y, vx, vy, h, G, s, n_steps):
+        for e in range(M.shape[0]):
+            member_s = Scratch(*(b[e] for b in s))
+            advance(M[e], x[e], y[e], vx[e], vy[e], h, G, member_s, n_steps)
+    return advance_ensemble
+
+
+advance_rk4_ensemble = ensemble_of(advance_rk4)
+advance_leapfrog_ensemble = ensemble_of(advance_leapfrog)
+advance_forest_ruth_ensemble = ensemble_of(advance_forest_ruth)
+
 try:
-    import rkfuncs
-    f1 = rkfuncs.gravity_first_order
+    from kernels import (gravity,
+                         advance_rk4, advance_leapfrog, advance_forest_ruth,
+                         advance_rk4_ensemble, advance_leapfrog_ensemble,
+                         advance_forest_ruth_ensemble)
+    f1 = gravity
+    have_kernels = True
 except (ModuleNotFoundError, ImportError):
-    warnings.simplefilter("default", ImportWarning)
-    warnings.warn("Unable to import compiled library rkfuncs, "
-                  "falling back to Python functions.",
-                  ImportWarning, stacklevel=2)
+    have_kernels = False
+    try:
+        import rkfuncs
+        f1 = rkfuncs.gravity_first_order
+    except (ModuleNotFoundError, ImportError):
+        warnings.simplefilter("default", ImportWarning)
+        warnings.warn("Unable to import numba kernels or compiled library rkfuncs, "
+                      "falling back to Python functions.",
+                      ImportWarning, stacklevel=2)
 
+try:
+    import rk_cy
+except (ModuleNotFoundError, ImportError):
+    rk_cy = None
 
-def make_increment_args(bodies, dv_x, dv_y, vx, vy, h):
-    args = []
-    for idx, b in enumerate(bodies):
-        # Extend slope for position: r + dv/dt*h
-        b1_x = b.x + vx[idx]*h
-        b1_y = b.y + vy[idx]*h
-
-        # Extend slope for velocity: dv/dt + d2v/dt2*h
-        b1_vx = b.vx + dv_x[idx]*h
-        b1_vy = b.vy + dv_y[idx]*h
 
-        # Create func args at increment
-        args.append(Body(b.M, b1_x, b1_y, b1_vx, b1_vy))
+def advance_rk4_cy(M, x, y, vx, vy, h, G, s, n_steps):
+    # rk_cy allocates its own stage buffers per call
+    rk_cy.run(M, x, y, vx, vy, h, G, n_steps)
 
-    return args
 
+try:
+    import kernels_cuda
+except (ModuleNotFoundError, ImportError):
+    kernels_cuda = None
 
-def plot_animated(points, ax_scale, footnote, write_mp4=False):
-    import itertools
-    import matplotlib.colors as mcolors
-    def update_plot(i, data, sct):
-        try:
-            sct.set_offsets(data[i])
-        except IndexError:
-            exit(0)
-        return sct
 
-    def make_colours(count):
-        colours = mcolors.XKCD_COLORS
-        cyc = []
-        idx = 0
-        for c in itertools.cycle(colours):
-            cyc.append(c)
-            idx += 1
-            if idx == count:
-                break
-        return cyc
+def integrate_dop853(state, t_f, G, t_eval, rtol=1e-10, atol=1e-12):
+    """
+      Integrate state from 0 to t_f with the adaptive eighth-order
+      Dormand-Prince method, returning the scipy solution at t_eval.
+      The state vector is laid out as [x..., y..., vx..., vy...].
+    """
+    from scipy.integrate import solve_ivp
 
-    fig, ax = plt.subplots()
-    ax.set(xlim=ax_scale[0], ylim=ax_scale[1])
+    N = len(state.M)
+    dv_x = np.empty(N, dtype=np.float64)
+    dv_y = np.empty(N, dtype=np.float64)
 
-    if footnote:
-        box = ax.get_position()
-        ax.set_position([box.x0, box.y0 + box.height * 0.05, box.width, box.height * 0.95])
-        plt.figtext(0.5, 0.01, footnote, ha="center", fontsize=6, bbox={"facecolor": "white", "alpha": 0.5, "pad": 4})
+    def rhs(t, u):
+        x, y, vx, vy = u.reshape(4, N)
+        f1(state.M, x, y, vx, vy, dv_x, dv_y, G)
+        return np.concatenate((vx, vy, dv_x, dv_y))
 
-    init_x = [p[0] for p in points[0]]
-    init_y = [p[1] for p in points[0]]
-    colours = make_colours(len(points[0]))
-    sct = plt.scatter(init_x, init_y, c=colours)
+    u0 = np.concatenate((state.x, state.y, state.vx, state.vy))
+    return solve_ivp(rhs, (0, t_f), u0, method="DOP853", t_eval=t_eval, rtol=rtol, atol=atol)
 
-    fps = 60
-    frame_args = {"cache_frame_data": False}
-    if write_mp4:
-        frame_args["frames"] = len(points)
 
-    ani = animation.FuncAnimation(fig, update_plot, interval=1000/fps, fargs=(points, sct), **frame_args)
+def open_frames(capacity, N):
+    """
+      Shared memory ring of capacity (N, 2) position frames for rk_view.py,
+      laid out as in rk_view.ring_views(). Returns the block with header,
+      frame and footnote views.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=block_size(capacity, N))
+    header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=shm.buf)
+    header[:] = (0, 0, N, capacity, 0)
+    header, points, footnote = ring_views(shm.buf)
 
-    if write_mp4:
-        writer = animation.FFMpegWriter(fps=fps, bitrate=-1)
-        ani.save("out.mp4", writer=writer)
+    @atexit.register
+    def close_frames():
+        # Also reached if integration raises, so the viewer stops waiting
+        header[1] = 1
+        shm.unlink()
 
-    plt.show()
+    return shm, header, points, footnote
 
 
 def make_footnote_text(bodies):
@@ -151,6 +320,10 @@ G = 6.67408313131313e-11   # N.m^2/Kg^2
 h = 0.002
 t = 0
 t_f = 60
+integrator = "forest_ruth"
+mixed_precision = False
+ensemble_size = 1
+ensemble_spread = 1.0
 ax_scale = ((-4e5, 4e5), (-4e5, 4e5))
 """
 """
@@ -168,49 +341,118 @@ G = 1
 h = 0.002
 t = 0
 t_f = 6.32591398*6
+# One of "rk4", "leapfrog", "forest_ruth" or adaptive "dop853"
+integrator = "forest_ruth"
+# Evaluate forces in float32, state remains float64. Needs the Numba
+# kernels, a fixed-step integrator and ensemble_size = 1
+mixed_precision = False
+# Integrate this many copies with perturbed positions (fixed-step only),
+# member 0 is unperturbed and is the one plotted
+ensemble_size = 1
+ensemble_spread = 1e-6
 ax_scale = ((-2.0, 2.0), (-1.5, 1.5))
 
+if mixed_precision:
+    if integrator == "dop853" or ensemble_size > 1:
+        raise ValueError("mixed_precision requires a fixed-step integrator and ensemble_size = 1")
+    if not have_kernels:
+        warnings.warn("mixed_precision requires the numba kernels, forces are evaluated in float64",
+                      RuntimeWarning)
+
 print('\033[?25l', end="")
+state = State.from_bodies(bodies)
+N = len(bodies)
+# Stage buffers are allocated once and updated in place
+scratch = make_scratch(N, mixed_precision, ensemble_size)
+system = state
+if ensemble_size > 1:
+    if integrator == "dop853":
+        raise ValueError("Ensembles require a fixed-step integrator")
+    system = make_ensemble(state, ensemble_size, ensemble_spread)
+    state = system.member(0)
+
+steps = math.ceil(t_f/h)
+sample_every = 10
+# Sampled positions, one (N, 2) frame per sample_every steps, are written
+# to a ring of at most max_samples frames and drawn by a viewer process
+N_frames = math.ceil(steps/sample_every)
+max_samples = 4096
+# Write every frame to out.mp4 once integrated, rather than viewing live
+write_mp4 = False
+ring_frames = N_frames if write_mp4 else min(N_frames, max_samples)
+shm, header, points, footnote = open_frames(ring_frames, N)
+view_args = [shm.name, *(str(lim) for lim in ax_scale[0] + ax_scale[1])]
+if N <= 4:
+    view_args.append("--footnote")
+if write_mp4:
+    view_args.append("--mp4")
+viewer = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "rk_view.py"),
+                           *view_args])
 step = 0
+frame = 0
 t0 = time.time()
-while t < t_f:
-    k1_x, k1_y, k1_vx, k1_vy = f1(bodies)
-    increments = make_increment_args(bodies, k1_x, k1_y, k1_vx, k1_vy, h/2)
-
-    k2_x, k2_y, k2_vx, k2_vy = f1(increments)
-    increments = make_increment_args(bodies, k2_x, k2_y, k2_vx, k2_vy, h/2)
-
-    k3_x, k3_y, k3_vx, k3_vy = f1(increments)
-    increments = make_increment_args(bodies, k3_x, k3_y, k3_vx, k3_vy, h)
-
-    k4_x, k4_y, k4_vx, k4_vy = f1(increments)
-
-    for idx, b in enumerate(bodies):
-        b_h_x = b.x + 1/6*(k1_vx[idx] + 2*(k2_vx[idx] + k3_vx[idx]) + k4_vx[idx])*h
-        b_h_y = b.y + 1/6*(k1_vy[idx] + 2*(k2_vy[idx] + k3_vy[idx]) + k4_vy[idx])*h
-        b_h_vx = b.vx + 1/6*(k1_x[idx] + 2*(k2_x[idx] + k3_x[idx]) + k4_x[idx])*h
-        b_h_vy = b.vy + 1/6*(k1_y[idx] + 2*(k2_y[idx] + k3_y[idx]) + k4_y[idx])*h
-
-        b.x = b_h_x
-        b.y = b_h_y
-        b.vx = b_h_vx
-        b.vy = b_h_vy
-
-    t += h
-    step += 1
+if integrator == "dop853":
+    # Error-controlled steps, sampled at the fixed-step frame interval
+    t_eval = np.minimum(np.arange(1, N_frames+1)*sample_every*h, t_f)
+    sol = integrate_dop853(state, t_f, G, t_eval)
+    if not sol.success:
+        raise RuntimeError(sol.message)
+    for k, sample in enumerate(sol.y[:2*N].reshape(2, N, N_frames).transpose(2, 1, 0)):
+        points[k % ring_frames] = sample
+        header[0] = k + 1
+    state.x[:], state.y[:], state.vx[:], state.vy[:] = sol.y[:, -1].reshape(4, N)
+    t = sol.t[-1]
+    print(f"{N_frames} frames, {sol.nfev} evaluations in {time.time()-t0:.2f}s")
+else:
+    advance = {
+        "rk4": advance_rk4,
+        "leapfrog": advance_leapfrog,
+        "forest_ruth": advance_forest_ruth,
+    }[integrator]
+
+    device = None
+    if ensemble_size > 1:
+        advance = {
+            "rk4": advance_rk4_ensemble,
+            "leapfrog": advance_leapfrog_ensemble,
+            "forest_ruth": advance_forest_ruth_ensemble,
+        }[integrator]
+    elif integrator == "rk4" and not mixed_precision:
+        # The compiled alternatives are single-system RK4 in float64 only
+        if (kernels_cuda is not None and N >= kernels_cuda.GPU_MIN_N
+                and kernels_cuda.is_available()):
+            # State is resident on the device, positions are copied back each call
+            device = kernels_cuda.DeviceRK4(state.M, state.x, state.y, state.vx, state.vy, G)
+            advance = device.advance
+        elif rk_cy is not None:
+            advance = advance_rk4_cy
+
+    while step < steps:
+        # Integrate between samples without returning to the loop
+        n_steps = min(sample_every, steps-step)
+        advance(system.M, system.x, system.y, system.vx, system.vy, h, G, scratch, n_steps)
+
+        t += n_steps*h
+        step += n_steps
 
-    if step % 10 == 0:
         t1 = time.time()
         t_h, t_h_s = divmod(t1-t0, 3600)
         t_m, t_s = divmod(t_h_s, 60)
-        steps = int(t_f/h)
-        if step > steps-10:
-            # Round up last print
-            step = steps
         sw = int(math.log10(steps)+1)
         print(f"\rstep: {step:>{sw}}/{steps:>{sw}}  {100*step/steps:4.2f}%  "
                 f"{t_h:02.0f}:{t_m:02.0f}:{t_s:02.0f}  ", end='')
-        points.append([(b.x, b.y) for b in bodies])
-print(f"{steps/(time.time()-t0):.2f} steps/s")
-footnote = make_footnote_text(bodies) if len(bodies)<=4 else None
-plot_animated(points, ax_scale, footnote, write_mp4=False)
+        points[frame % ring_frames, :, 0] = state.x
+        points[frame % ring_frames, :, 1] = state.y
+        frame += 1
+        # Publish only once the frame is written, the viewer polls this
+        header[0] = frame
+    if device is not None:
+        device.copy_velocities(state.vx, state.vy)
+    print(f"{steps/(time.time()-t0):.2f} steps/s")
+    if ensemble_size > 1:
+        dev2 = (system.x[1:] - state.x)**2 + (system.y[1:] - state.y)**2
+        print(f"Ensemble of {ensemble_size}, RMS deviation from member 0: {np.sqrt(dev2.mean()):.3e}")
+if N <= 4:
+    write_footnote(header, footnote, make_footnote_text(state.to_bodies()))
+header[1] = 1
+viewer.wait()
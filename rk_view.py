@@ -0,0 +1,163 @@
+"""
+  Live viewer for rk_nbody.py, run as a separate process.
+
+  Reads sampled positions from the shared memory frame ring written by
+  the integrator and animates them as they are published. With --mp4
+  waits for the integration to finish and writes every frame to out.mp4.
+
+  The block layout helpers are also used by rk_nbody.py to create the
+  ring, so matplotlib is only imported once plotting starts.
+
+  usage: rk_view.py SHM_NAME XMIN XMAX YMIN YMAX [--footnote] [--mp4]
+"""
+import argparse
+import itertools
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+# int64 header words: published frame count, done flag, N, ring capacity,
+# footnote length in bytes
+HEADER_LEN = 5
+# Footnote text region, following the frames
+FOOTNOTE_BYTES = 4096
+
+
+def block_size(capacity, N):
+    return HEADER_LEN*8 + capacity*N*2*8 + FOOTNOTE_BYTES
+
+
+def ring_views(buf):
+    """
+      Views of (header, frames, footnote bytes) in the shared block buf,
+      whose header is already initialised.
+    """
+    header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=buf)
+    N, capacity = int(header[2]), int(header[3])
+    points = np.ndarray((capacity, N, 2), dtype=np.float64, buffer=buf, offset=header.nbytes)
+    footnote = np.ndarray((FOOTNOTE_BYTES,), dtype=np.uint8, buffer=buf,
+                          offset=header.nbytes + points.nbytes)
+    return header, points, footnote
+
+
+def attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before 3.13 attaching registers the block with this process's
+        # resource tracker, which would unlink it on exit
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def footnote_text(header, footnote):
+    return footnote[:header[4]].tobytes().decode(errors="ignore")
+
+
+def write_footnote(header, footnote, text):
+    data = np.frombuffer(text.encode()[:FOOTNOTE_BYTES], dtype=np.uint8)
+    footnote[:len(data)] = data
+    header[4] = len(data)
+
+
+def make_colours(count):
+    import matplotlib.colors as mcolors
+    return list(itertools.islice(itertools.cycle(mcolors.XKCD_COLORS), count))
+
+
+def make_plot(N, ax_scale, footnote):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.set(xlim=ax_scale[0], ylim=ax_scale[1])
+
+    text = None
+    if footnote:
+        box = ax.get_position()
+        ax.set_position([box.x0, box.y0 + box.height * 0.05, box.width, box.height * 0.95])
+        text = plt.figtext(0.5, 0.01, "", ha="center", fontsize=6, bbox={"facecolor": "white", "alpha": 0.5, "pad": 4})
+
+    sct = plt.scatter(np.zeros(N), np.zeros(N), c=make_colours(N))
+    return fig, sct, text
+
+
+def plot_live(header, points, footnote, ax_scale, show_footnote=False):
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+
+    capacity, N = points.shape[:2]
+    fig, sct, text = make_plot(N, ax_scale, show_footnote)
+    shown = 0
+
+    def update_plot(_):
+        nonlocal shown
+        published = int(header[0])
+        if shown == published:
+            if header[1] and text is None:
+                plt.close(fig)
+            elif header[1]:
+                # Footnote is written before the done flag is set, hold
+                # the last frame with it until the window is closed
+                text.set_text(footnote_text(header, footnote))
+                ani.event_source.stop()
+            return sct
+        # Skip frames the integrator has overwritten or may be writing,
+        # slot published % capacity is the next to be filled
+        shown = max(shown, published - capacity + 1)
+        sct.set_offsets(points[shown % capacity])
+        shown += 1
+        return sct
+
+    fps = 60
+    ani = animation.FuncAnimation(fig, update_plot, interval=1000/fps, cache_frame_data=False)
+    plt.show()
+    return ani
+
+
+def write_mp4(header, points, footnote, ax_scale, show_footnote=False, path="out.mp4"):
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+
+    while not header[1]:
+        time.sleep(0.1)
+
+    capacity, N = points.shape[:2]
+    published = int(header[0])
+    first = max(0, published - capacity)
+    if first:
+        print(f"Ring holds {capacity} of {published} frames, writing the last {capacity}")
+
+    fig, sct, text = make_plot(N, ax_scale, show_footnote)
+    if text is not None:
+        text.set_text(footnote_text(header, footnote))
+
+    def update_plot(i):
+        sct.set_offsets(points[i % capacity])
+        return sct
+
+    fps = 60
+    ani = animation.FuncAnimation(fig, update_plot, frames=range(first, published), cache_frame_data=False)
+    writer = animation.FFMpegWriter(fps=fps, bitrate=-1)
+    ani.save(path, writer=writer)
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Animate frames published by rk_nbody.py")
+    parser.add_argument("shm_name")
+    parser.add_argument("limits", nargs=4, type=float, metavar="LIM", help="XMIN XMAX YMIN YMAX")
+    parser.add_argument("--footnote", action="store_true", help="show the final bodies below the plot")
+    parser.add_argument("--mp4", action="store_true", help="write all frames to out.mp4 once integrated")
+    args = parser.parse_args()
+
+    shm = attach(args.shm_name)
+    ax_scale = tuple(args.limits[:2]), tuple(args.limits[2:])
+    header, points, footnote = ring_views(shm.buf)
+    if args.mp4:
+        write_mp4(header, points, footnote, ax_scale, args.footnote)
+    else:
+        plot_live(header, points, footnote, ax_scale, args.footnote)
+    del header, points, footnote
+    shm.close()
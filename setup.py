@@ -1,9 +1,97 @@
+import os
+import shutil
+import subprocess
+import sys
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+
+# Profiles from the instrumented build are collected here
+PGO_DIR = os.path.abspath("pgo")
+
+# Force evaluations covering both the serial and threaded kernel paths
+PGO_TRAINING = """
+import numpy as np
+import rkfuncs
+rng = np.random.default_rng(0)
+for N, reps in ((3, 20000), (1024, 20)):
+    M, x, y, vx, vy = rng.random((5, N))
+    dv_x, dv_y = np.empty(N), np.empty(N)
+    for _ in range(reps):
+        rkfuncs.gravity_first_order(M, x, y, vx, vy, dv_x, dv_y, 1.0)
+"""
+
+rkfuncs = Extension("rkfuncs",
+    sources=["lib/rkfuncs.c"],
+    extra_compile_args=["-Wall", "-O3", "-march=native", "-ffast-math", "-fopenmp"],
+    extra_link_args=["-fopenmp"],
+)
+ext_modules = [rkfuncs]
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # Cython integrator is optional, rkfuncs builds without it
+    pass
+else:
+    ext_modules += cythonize([
+        Extension("rk_cy",
+            sources=["lib/rk_cy.pyx"],
+            extra_compile_args=["-O3", "-ffast-math", "-march=native", "-fopenmp"],
+            extra_link_args=["-fopenmp"],
+        )
+    ])
+
+
+class build_ext_pgo(build_ext):
+    """
+      build_ext with a --pgo option to build rkfuncs with profile-guided
+      optimisation: an instrumented build is run on PGO_TRAINING, then
+      rkfuncs is rebuilt using the collected profile.
+    """
+    user_options = build_ext.user_options + [
+        ("pgo", None, "build rkfuncs with profile-guided optimisation"),
+    ]
+    boolean_options = build_ext.boolean_options + ["pgo"]
+
+    def initialize_options(self):
+        super().initialize_options()
+        self.pgo = False
+
+    def run(self):
+        if not self.pgo:
+            return super().run()
+
+        extensions = self.extensions
+        compiler = self.compiler
+        compile_args = rkfuncs.extra_compile_args
+        link_args = rkfuncs.extra_link_args
+        shutil.rmtree(PGO_DIR, ignore_errors=True)
+        # Both passes always recompile so flags match the profile
+        self.force = True
+        try:
+            self.extensions = [rkfuncs]
+            rkfuncs.extra_compile_args = compile_args + [f"-fprofile-generate={PGO_DIR}"]
+            rkfuncs.extra_link_args = link_args + [f"-fprofile-generate={PGO_DIR}"]
+            super().run()
+
+            module_dir = os.path.dirname(os.path.abspath(self.get_ext_fullpath(rkfuncs.name)))
+            subprocess.check_call([sys.executable, "-c", PGO_TRAINING],
+                                  env=dict(os.environ, PYTHONPATH=module_dir))
+
+            rkfuncs.extra_compile_args = compile_args + [f"-fprofile-use={PGO_DIR}", "-fprofile-correction"]
+            rkfuncs.extra_link_args = link_args
+            self.extensions = extensions
+            # run() replaces the compiler name with a compiler instance
+            self.compiler = compiler
+            super().run()
+        finally:
+            self.extensions = extensions
+            rkfuncs.extra_compile_args = compile_args
+            rkfuncs.extra_link_args = link_args
+
 
 setup(
     name="rkfuncs",
-    ext_modules=[Extension("rkfuncs",
-        sources=["lib/rkfuncs.c"],
-        extra_compile_args=["-Wall"],
-    )]
+    ext_modules=ext_modules,
+    cmdclass={"build_ext": build_ext_pgo},
 )